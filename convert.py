@@ -1,8 +1,13 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from functools import lru_cache
+from itertools import zip_longest
 from pathlib import Path
+import os
 import re
-import pandas as pd
 import shutil
 import subprocess
+import sys
 
 # Path to where the MetacatUI files are located
 metacatui_dir = "path/to/metacatui"
@@ -12,96 +17,107 @@ metacatui_dir = Path(metacatui_dir)
 output_dir = "./metacatui-es6/"
 output_dir = Path(output_dir)
 
-# Patterns for finding the files to convert
+# Patterns for finding the files to convert, as (top-level directory,
+# directory anywhere below it, file name). None matches anything. Each JS file
+# is assigned to the first category that it matches.
 patterns = {
-    "view": "src/**/views/**/*.js",
-    "model": "src/**/models/**/*.js",
-    "collection": "src/**/collections/**/*.js",
-    "router": "src/**/routers/**/*.js",
-    "test": "tests/**/*.js",
-    "config": "src/**/config.js",
-    "other": "src/**/*.js",  # This is the catch-all pattern
+    "view": ("src", "views", None),
+    "model": ("src", "models", None),
+    "collection": ("src", "collections", None),
+    "router": ("src", "routers", None),
+    "test": ("tests", None, None),
+    "config": ("src", None, "config.js"),
+    "other": ("src", None, None),  # This is the catch-all pattern
 }
 # Ignore manually imported dependencies and the code for the DataONE website
 ignore_patterns = ["src/components/**/*.js", "**/d1website.min.js"]
 
+# Print each comment and MetacatUI.root string that is removed
+DEBUG = False
 
-# Create a copy of the MetacatUI directory that we'll edit
-shutil.copytree(metacatui_dir, output_dir, ignore=shutil.ignore_patterns(".git"))
-
-# Init a new git repo in the output directory so we can inspect the changes
-subprocess.run(["git", "init"], cwd=output_dir)
-subprocess.run(["git", "add", "."], cwd=output_dir)
-subprocess.run(
-    ["git", "commit", "-m", "Original files before conversion"], cwd=output_dir
-)
 
 ## ----- Find files ----- ##
 
 
-def get_theme(path):
-    """Identifies the theme of a file based on the path."""
-    parts = path.split("/")
-    if "themes" in parts:
-        theme_index = parts.index("themes")
-        return parts[theme_index + 1]
-    else:
+@lru_cache(maxsize=None)
+def get_theme(dir_parts):
+    """Identifies the theme of a file based on the parts of its directory path.
+    Files in the same directory share the cached result."""
+    try:
+        theme_index = dir_parts.index("themes")
+    except ValueError:
         return None
+    if theme_index + 1 < len(dir_parts):
+        return dir_parts[theme_index + 1]
+    return None
+
+
+def get_category(parts):
+    """Identifies the category of a file based on its path parts, relative to
+    the output directory."""
+    top, dirs, name = parts[0], parts[1:-1], parts[-1]
+    for category, (top_dir, sub_dir, file_name) in patterns.items():
+        if top != top_dir:
+            continue
+        if sub_dir is not None and sub_dir not in dirs:
+            continue
+        if file_name is not None and name != file_name:
+            continue
+        return category
+    return None
+
 
+def find_js_files(directory):
+    """Walks the top-level directories in the patterns once, yielding every JS
+    file found."""
+    top_dirs = dict.fromkeys(top_dir for top_dir, _, _ in patterns.values())
+    for top_dir in top_dirs:
+        for dirpath, dirnames, filenames in os.walk(directory / top_dir):
+            for name in filenames:
+                if name.endswith(".js"):
+                    yield Path(dirpath, name)
 
-def filter_files(files, ignore, visited):
-    """Filters a list of files based on the ignore list and visited list."""
-    filtered = []
-    for f in files:
-        if f not in visited and f not in ignore:
-            visited.add(f)
-            filtered.append(f)
-    return filtered
-
-# Track the paths, categories, and themes of the files we visit
-visited_files = set()
-paths = []
-categories = []
-themes = []
-ignore_files = set()
-[ignore_files.update(output_dir.glob(p)) for p in ignore_patterns]
-
-for category, pattern in patterns.items():
-    all_files = list(output_dir.glob(pattern))
-    filtered_files = filter_files(all_files, ignore_files, visited_files)
-    for f in filtered_files:
-        paths.append(f)
-        categories.append(category)
-        themes.append(get_theme(str(f)))
 
 ## ----- Manipulate files ----- ##
 
+# Regex patterns used when converting files, compiled once at import time
+_COMMENT_RE = re.compile(r"//[^\n\r]*|/\*.*?\*/", re.DOTALL)
+_MCROOT_RE = re.compile(r'["\']?\s*\+?\s*MetacatUI\.root\s*\+?\s*["\']?', re.DOTALL)
+_DEP_RE = re.compile(r'["\'](.+?)["\']')
+_RETURN_RE = re.compile(
+    r"return\s*(?P<export_name>[a-zA-Z0-9_]+)\s*;?\s*\}\s*\);?", re.DOTALL
+)
+# Finds both the @class tag and the return statement in a single pass. The class
+# name is in a lookahead so that it can't hide a return statement from the scan.
+_CLASS_OR_RETURN_RE = re.compile(
+    r"(?P<class_tag>@class\s+(?=(?P<class_name>\w+)))"
+    r"|(?P<return_statement>return\s*(?P<export_name>[a-zA-Z0-9_]+)\s*;?\s*\}\s*\);?)"
+)
+_BACKBONE_EXTEND_RE = re.compile(r"return\s+?Backbone\.(.*?)extend\(")
+
 # IMPORTS
 
 
+def has_comments(text):
+    """Checks if text could contain a JS comment, without using a regex."""
+    return "//" in text or "/*" in text
+
+
 def remove_comments(text):
-    """Remove JS comments (//) from text."""
-    # Find // until the end of the line (/n or /r or /r/n)
-    pattern = r"\/\/.*?[\n\r]"
-    compiled_pattern = re.compile(pattern, re.DOTALL)
-    # Find for print statements
-    matches = compiled_pattern.findall(text)
-    for match in matches:
-        print(f"Removing comment: {match}")
-        # Remove the comments
-        text = text.replace(match, "")
-    return text
+    """Remove JS comments (// and /* */) from text."""
+    # Find // until the end of the line, or /* until the next */
+    if DEBUG:
+        for match in _COMMENT_RE.findall(text):
+            print(f"Removing comment: {match}")
+    return _COMMENT_RE.sub("", text)
 
 
 def remove_metacatui_root(text):
     """Remove MetacatUI.root from import paths."""
-    mc_pattern = r'["\']?\s*\+?\s*MetacatUI\.root\s*\+?\s*["\']?'
-    compiled_pattern = re.compile(mc_pattern, re.DOTALL)
-    matches = compiled_pattern.findall(text)
-    for match in matches:
-        print(f"Removing MetacatUI.root: {match}")
-        text = text.replace(match, "")
-    return text
+    if DEBUG:
+        for match in _MCROOT_RE.findall(text):
+            print(f"Removing MetacatUI.root: {match}")
+    return _MCROOT_RE.sub("", text)
 
 
 def is_text(dep):
@@ -115,30 +131,79 @@ def is_text(dep):
 
 def parse_dependencies(dependencies):
     """Parses the dependencies string into a list of dependencies."""
-    dependencies = remove_comments(dependencies)
-    dependencies = remove_metacatui_root(dependencies)
-    dep_pattern = r'["\'](.+?)["\']'
-    dep_match = re.findall(dep_pattern, dependencies)
+    # Only run the regexes when there is something for them to remove
+    if has_comments(dependencies):
+        dependencies = remove_comments(dependencies)
+    if "MetacatUI.root" in dependencies:
+        dependencies = remove_metacatui_root(dependencies)
+    # The same few dependencies are used across many files, so share one copy
+    dep_match = [sys.intern(x) for x in _DEP_RE.findall(dependencies)]
     return dep_match
 
 
 def parse_parameters(parameters):
     """Parses the parameters string into a list of parameters."""
-    parameters = remove_comments(parameters)
-    param_match = [x.strip() for x in parameters.split(",")]
+    if has_comments(parameters):
+        parameters = remove_comments(parameters)
+    param_match = [sys.intern(x.strip()) for x in parameters.split(",")]
     return param_match
 
 
+def skip_whitespace(text, i):
+    """Returns the index of the first non-whitespace character at or after i."""
+    while i < len(text) and text[i].isspace():
+        i += 1
+    return i
+
+
+def parse_define_statement(js_text, start):
+    """
+    Parses a `define([dependencies], function (parameters) {` statement that
+    begins at index start. Returns the end index of the statement and the
+    dependencies and parameters strings, or None if the text doesn't match.
+    """
+    i = skip_whitespace(js_text, start + len("define"))
+    if not js_text.startswith("(", i):
+        return None
+    i = skip_whitespace(js_text, i + 1)
+    if not js_text.startswith("[", i):
+        return None
+    deps_end = js_text.find("]", i + 1)
+    if deps_end <= i + 1:
+        return None
+    dependencies = js_text[i + 1 : deps_end]
+    i = skip_whitespace(js_text, deps_end + 1)
+    if not js_text.startswith(",", i):
+        return None
+    i = skip_whitespace(js_text, i + 1)
+    if not js_text.startswith("function", i):
+        return None
+    i = skip_whitespace(js_text, i + len("function"))
+    if not js_text.startswith("(", i):
+        return None
+    params_end = js_text.find(")", i + 1)
+    if params_end <= i + 1:
+        return None
+    parameters = js_text[i + 1 : params_end]
+    i = skip_whitespace(js_text, params_end + 1)
+    if not js_text.startswith("{", i):
+        return None
+    return i + 1, dependencies, parameters
+
+
 def find_require_define_text(js_text):
     """Finds the requireJS define statement at the top of the file."""
-    pattern = "define\s*\(\s*\[([^\]]+)\]\s*,\s*function\s*\(([^)]+)\)\s*\{"
-    compiled_pattern = re.compile(pattern, re.DOTALL)
-    match = compiled_pattern.search(js_text)
-    if match is None:
+    # Try each "define" in turn until one starts a complete define statement
+    start = js_text.find("define")
+    while start != -1:
+        parsed = parse_define_statement(js_text, start)
+        if parsed is not None:
+            break
+        start = js_text.find("define", start + 1)
+    else:
         return None
-    entire_match = match.group(0)
-    dependencies = match.group(1)
-    parameters = match.group(2)
+    end, dependencies, parameters = parsed
+    entire_match = js_text[start:end]
     return {
         "match": entire_match,
         "dependencies": parse_dependencies(dependencies),
@@ -151,36 +216,27 @@ def write_import_statements(dependencies, parameters):
     # Check that we have the same number of dependencies and parameters
     if len(dependencies) != len(parameters):
         print("Warning: number of dependencies and parameters do not match")
-    import_statements = ""
-    # Use the longer range to make sure we get all the dependencies
-    length = max(len(dependencies), len(parameters))
+    import_statements = []
     ignored_deps = []
     ignored_params = []
-    for i in range(length):
-        try:
-            dep = dependencies[i]
-        except IndexError:
-            dep = None
-        try:
-            param = parameters[i]
-        except IndexError:
-            param = None
+    # Use the longer list to make sure we get all the dependencies
+    for dep, param in zip_longest(dependencies, parameters):
         if dep is None:
             print(f"Warning: parameter {param} has no dependency")
-            ignored_deps.append(dep)
+            ignored_params.append(param)
             continue
         if param is None:
             print(f"Warning: dependency {dep} has no parameter")
-            ignored_params.append(param)
+            ignored_deps.append(dep)
             continue
         if is_text(dep):
             # Check for and remove the !text prefix
             if dep.startswith("text!"):
                 dep = dep[5:]
         statement = f"import {param} from '{dep}';\n"
-        import_statements += statement
+        import_statements.append(statement)
     return {
-        "text": import_statements,
+        "text": "".join(import_statements),
         "ignored_dependencies": ignored_deps,
         "ignored_parameters": ignored_params,
     }
@@ -189,46 +245,63 @@ def write_import_statements(dependencies, parameters):
 # EXPORTS
 
 
+def find_class_and_return(js_text):
+    """Finds the first @class name and the first return statement match in a
+    single scan of the text."""
+    class_name = None
+    return_match = None
+    # A substring check is much cheaper than the regex for files without either
+    if "@class" not in js_text and "return" not in js_text:
+        return class_name, return_match
+    for match in _CLASS_OR_RETURN_RE.finditer(js_text):
+        if match.lastgroup == "class_tag":
+            if class_name is None:
+                class_name = match.group("class_name")
+        elif return_match is None:
+            return_match = match
+        if class_name is not None and return_match is not None:
+            break
+    return class_name, return_match
+
+
 def find_return_text(js_text):
     """Finds the return statement at the end of the file."""
-    js_text_standard = standardize_return_text(js_text)
-    js_text = js_text_standard["text"]
+    class_name, match = find_class_and_return(js_text)
+    js_text_standard = standardize_return_text(js_text, class_name)
     export_name = js_text_standard["export_name"]
-    pattern = r"return\s*([a-zA-Z0-9_]+)\s*;?\s*\}\s*\);?"
-    compiled_pattern = re.compile(pattern, re.DOTALL)
-    match = compiled_pattern.search(js_text)
+    if js_text_standard["text"] != js_text:
+        # The last closing bracket may have been removed with the Backbone
+        # return statement, so search the standardized text again
+        match = _RETURN_RE.search(js_text_standard["text"])
     if match is not None:
-        return {"match": match.group(0), "export_name": match.group(1)}
+        return {"match": match.group(0), "export_name": match.group("export_name")}
+    # The export name may still come from the @class tag without a return
     elif export_name:
         return {"match": None, "export_name": export_name}
     else:
         return None
 
 
-def standardize_return_text(js_text):
+def standardize_return_text(js_text, class_name):
     """
     Convert statements in the format `return Backbone...extend({})` to
-    `var ExportName = Backbone...extend({})
+    `var ExportName = Backbone...extend({})`, where ExportName is the class
+    name from the @class tag
     """
-    class_name_match = re.search(r"@class\s+(\w+)", js_text)
     new_text = js_text
-    class_name = None
 
     # If the class name is found
-    if class_name_match:
-        class_name = class_name_match.group(1)
-
-        # Regex pattern to search for 'return Backbone.{anything}extend('
-        pattern = r"return\s+?Backbone\.(.*?)extend\("
+    if class_name:
+        # Don't continue if 'return Backbone.{anything}extend(' can't match
+        if "Backbone." not in js_text or "extend(" not in js_text:
+            return {"text": new_text, "export_name": class_name}
 
-        # Don't continue if a match is not found for the pattern
-        if re.search(pattern, js_text):
+        # The replacement string using the found class name
+        replacement = f"var {class_name} = Backbone.\\1extend("
 
-            # The replacement string using the found class name
-            replacement = f"var {class_name} = Backbone.\\1extend("
-
-            # Use re.sub to find and replace the string
-            new_text = re.sub(pattern, replacement, js_text)
+        # Find and replace the string, searching for it only once
+        new_text, count = _BACKBONE_EXTEND_RE.subn(replacement, js_text)
+        if count:
             new_text = remove_last_closing_bracket(new_text)
 
     return {"text": new_text, "export_name": class_name}
@@ -236,9 +309,16 @@ def standardize_return_text(js_text):
 
 def remove_last_closing_bracket(text):
     """Removes the last } and ) characters from the text."""
-    pattern = r"\}\s*\)\s*;?\s*$"
-    modified_text = re.sub(pattern, "", text, count=1, flags=re.DOTALL)
-    return modified_text
+    # Trim `}` `)` and an optional `;` off the end, allowing whitespace between
+    modified_text = text.rstrip()
+    if modified_text.endswith(";"):
+        modified_text = modified_text[:-1].rstrip()
+    if not modified_text.endswith(")"):
+        return text
+    modified_text = modified_text[:-1].rstrip()
+    if not modified_text.endswith("}"):
+        return text
+    return modified_text[:-1]
 
 
 def write_export_statement(export_name):
@@ -249,10 +329,13 @@ def write_export_statement(export_name):
 def require_to_import_export(js_text):
     """Converts the requireJS define statement to an import/export statement."""
 
-    new_text = js_text
+    # The import statements, the body of the file, and the export statement,
+    # joined once at the end
+    imports = ""
+    body = js_text
+    exports = ""
     errors = []
     props = {
-        "original_text": js_text,
         "dependencies": [],
         "parameters": [],
         "export_name": None,
@@ -271,7 +354,7 @@ def require_to_import_export(js_text):
         props["dependencies"] = define["dependencies"]
         props["parameters"] = define["parameters"]
         # Remove the define statement from the text
-        new_text = new_text.replace(define["match"], "")
+        body = body.replace(define["match"], "")
         # Write the import statements
         import_text = write_import_statements(
             define["dependencies"], define["parameters"]
@@ -280,13 +363,13 @@ def require_to_import_export(js_text):
             errors.append("Error writing import statements")
         else:
             # Add the import statements to the top of the file
-            new_text = import_text["text"] + new_text
+            imports = import_text["text"]
             props["ignored_dependencies"] = import_text["ignored_dependencies"]
             props["ignored_parameters"] = import_text["ignored_parameters"]
 
     # Find the return statement
 
-    return_statement = find_return_text(new_text)
+    return_statement = find_return_text(body)
 
     if return_statement is None:
         errors.append("No return statement found")
@@ -294,16 +377,16 @@ def require_to_import_export(js_text):
         props["export_name"] = return_statement["export_name"]
         # Remove the return statement from the text.
         if return_statement["match"]:
-            new_text = new_text.replace(return_statement["match"], "")
+            body = body.replace(return_statement["match"], "")
         # Write the export statement
         export_text = write_export_statement(return_statement["export_name"])
         if export_text is None:
             errors.append("Error writing export statement")
         else:
             # Add the export statement to the end of the file
-            new_text = new_text + export_text
+            exports = export_text
 
-    props["new_text"] = new_text
+    props["new_text"] = "".join((imports, body, exports))
     props["errors"] = errors
 
     return props
@@ -311,40 +394,90 @@ def require_to_import_export(js_text):
 
 ## ----- Write files ----- ##
 
-props = []
-
-for p in paths:
-    with open(p, "r") as f:
-        js_text = f.read()
-        converted = require_to_import_export(js_text)
-        props.append(converted)
-
-df = pd.DataFrame(
-    {
-        "path": paths,
-        "category": categories,
-        "theme": themes,
-        "new_text": [p["new_text"] for p in props],
-        "original_text": [p["original_text"] for p in props],
-        "dependencies": [p["dependencies"] for p in props],
-        "parameters": [p["parameters"] for p in props],
-        "num_dependencies": [len(p["dependencies"]) for p in props],
-        "num_parameters": [len(p["parameters"]) for p in props],
-        "ignored_dependencies": [p["ignored_dependencies"] for p in props],
-        "ignored_parameters": [p["ignored_parameters"] for p in props],
-        "errors": [p["errors"] for p in props],
-        "export_name": [p["export_name"] for p in props],
-    }
-)
-
-
-# Write the new files
-for i, row in df.iterrows():
-    path = row["path"]
-    new_text = row["new_text"]
-    with open(path, "w") as f:
-        f.write(new_text)
 
-# Save a record of the changes
-df = df.drop(columns=["new_text", "original_text"])
-df.to_csv("record-files-edited.csv", index=False)
+def process_file(path):
+    """Converts a file in place and returns the details of the conversion."""
+    # MetacatUI's source is UTF-8; naming the codec skips the locale lookup
+    # and keeps the conversion independent of the platform's default encoding
+    converted = require_to_import_export(path.read_text(encoding="utf-8"))
+    # Write the new file right away so only the metadata is kept in memory
+    path.write_text(converted.pop("new_text"), encoding="utf-8")
+    return converted
+
+
+if __name__ == "__main__":
+    # Create a copy of the MetacatUI directory that we'll edit
+    shutil.copytree(metacatui_dir, output_dir, ignore=shutil.ignore_patterns(".git"))
+
+    # Init a new git repo in the output directory so we can inspect the changes
+    git = ["git", "-c", "core.autocrlf=false"]
+    subprocess.run(git + ["init", "--quiet"], cwd=output_dir)
+    subprocess.run(git + ["add", "-A"], cwd=output_dir)
+    subprocess.run(
+        git
+        + ["commit", "--quiet", "--allow-empty"]
+        + ["-m", "Original files before conversion"],
+        cwd=output_dir,
+        stdout=subprocess.DEVNULL,
+    )
+
+    # Track the paths, categories, and themes of the files we visit
+    paths = []
+    categories = []
+    themes = []
+    # Compare ignored files as strings, which hash faster than Path objects
+    ignore_files = {str(f) for p in ignore_patterns for f in output_dir.glob(p)}
+
+    # Sort the files into categories with a single walk of the directory
+    files_by_category = {category: [] for category in patterns}
+    for f in find_js_files(output_dir):
+        if str(f) in ignore_files:
+            continue
+        category = get_category(f.relative_to(output_dir).parts)
+        if category is not None:
+            files_by_category[category].append(f)
+
+    for category, files in files_by_category.items():
+        for f in files:
+            paths.append(f)
+            categories.append(category)
+            themes.append(get_theme(f.parent.parts))
+
+    # Convert and write the files in parallel, one worker per CPU, and save a
+    # record of the changes as each result comes back
+    with ProcessPoolExecutor() as executor, open(
+        "record-files-edited.csv", "w", newline=""
+    ) as record:
+        writer = csv.writer(record, lineterminator="\n")
+        writer.writerow(
+            [
+                "path",
+                "category",
+                "theme",
+                "dependencies",
+                "parameters",
+                "num_dependencies",
+                "num_parameters",
+                "ignored_dependencies",
+                "ignored_parameters",
+                "errors",
+                "export_name",
+            ]
+        )
+        props = executor.map(process_file, paths, chunksize=32)
+        for path, category, theme, p in zip(paths, categories, themes, props):
+            writer.writerow(
+                [
+                    path,
+                    category,
+                    theme,
+                    p["dependencies"],
+                    p["parameters"],
+                    len(p["dependencies"]),
+                    len(p["parameters"]),
+                    p["ignored_dependencies"],
+                    p["ignored_parameters"],
+                    p["errors"],
+                    p["export_name"],
+                ]
+            )